@@ -1,11 +1,39 @@
+from functools import lru_cache
 from pathlib import Path
+import os
 import yaml
 
+# HLS để trên tmpfs: FFmpeg ghi segment và WebUI đọc lại đều nằm trong RAM,
+# không đi qua thẻ SD (chậm + mòn). Đổi chỗ khác bằng PICAM_HLS_DIR trong
+# /etc/default/picam (recorder và WebUI cùng đọc) hoặc paths.hls_dir
+HLS_DIR_DEFAULT = "/dev/shm/picam_hls"
+
 def load(path: str | Path) -> dict:
-    """Read a YAML file -> dict. Raises if file missing/invalid."""
-    p = Path(path)
-    if not p.exists():
-        raise FileNotFoundError(f"Config not found: {p}")
-    with p.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
-    return data
+    """Read a YAML file -> dict. Raises if file missing/invalid.
+
+    Parsed once per (file, mtime) per process; callers share the dict, so treat it as read-only.
+    """
+    p = Path(path).resolve()
+    try:
+        mtime = p.stat().st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Config not found: {p}") from None
+    return _load_yaml(str(p), mtime)
+
+
+@lru_cache(maxsize=8)
+def _load_yaml(path: str, mtime_ns: int) -> dict:
+    # mtime_ns nằm trong key: sửa file config thì lần load sau parse lại
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def hls_dir(cfg: dict) -> Path:
+    """Thư mục HLS theo $PICAM_HLS_DIR hoặc paths.hls_dir.
+
+    Chỉ phụ thuộc config, không tự đổi theo dung lượng trống: recorder và mọi
+    worker WebUI phải ra cùng 1 thư mục.
+    """
+    return Path(os.environ.get("PICAM_HLS_DIR")
+                or ((cfg or {}).get("paths") or {}).get("hls_dir")
+                or HLS_DIR_DEFAULT)
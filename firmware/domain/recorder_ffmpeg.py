@@ -7,23 +7,72 @@ UPDATED VERSION - Thêm overlay timestamp và tự động khởi động lại
 import os
 import sys
 import time
+import select
 import signal
 import subprocess
-import re
 from datetime import datetime
 from pathlib import Path
-import queue
 import threading
-import traceback
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
 from firmware.hal.usb_manager import USBManager
 from firmware.hal.gpio_leds import gpioLed
-from firmware.hal.gnss import GNSSModule
-from firmware.hal.rtc import rtcModule
-from firmware.hal.micro import Micro
-from firmware.config.config_loader import load
+from firmware.hal.inotify import DirWatch, IN_CLOSE_WRITE, IN_MOVED_TO
+from firmware.config.config_loader import load, hls_dir
+from firmware.domain.utils_logger import get_logger
+
+# Mọi thông báo của recorder (thread monitor USB, start/stop, vòng khởi động
+# lại trong main) đi qua 1 queue (xem utils_logger): 1 kênh duy nhất ra stdout,
+# không print() xen ngang thread listener -> thứ tự dòng log giữ nguyên
+log = get_logger("picam.recorder")
+
+# Kết quả dò `ffmpeg -encoders` (None = chưa dò, False = dò lỗi -> tin theo
+# config); chỉ fork ffmpeg 1 lần mỗi process, kể cả khi dò lỗi
+_HWENC = None
+
+
+def _ffmpeg_has_encoder(name):
+    """FFmpeg đang cài có encoder `name` không (vd h264_v4l2m2m)"""
+    global _HWENC
+    if _HWENC is None:
+        try:
+            out = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                capture_output=True, text=True, timeout=10,
+            ).stdout
+            # Dòng dạng " V....D h264_v4l2m2m   V4L2 mem2mem H.264 encoder wrapper"
+            _HWENC = frozenset(
+                parts[1] for parts in (line.split() for line in out.splitlines())
+                if len(parts) >= 2 and parts[0].startswith('V')
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            log.warning("⚠️ Could not probe FFmpeg encoders: %s", e)
+            _HWENC = False
+    return _HWENC is False or name in _HWENC
+
+
+def _v4l2_input_format(device, video_size):
+    """'mjpeg' nếu camera xuất MJPG đúng độ phân giải, ngược lại 'yuyv422'.
+    MJPEG: camera gửi khung đã nén, tải USB giảm nhiều lần so với YUYV thô"""
+    try:
+        out = subprocess.run(
+            ['v4l2-ctl', '--list-formats-ext', '-d', device],
+            capture_output=True, text=True, timeout=5,
+        ).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        log.warning("⚠️ Could not probe V4L2 formats: %s", e)
+        return 'yuyv422'
+    # Khối dạng:  [1]: 'MJPG' (Motion-JPEG, compressed)
+    #                 Size: Discrete 640x480
+    fourcc = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('[') and "'" in line:
+            fourcc = line.split("'")[1]
+        elif fourcc == 'MJPG' and line.startswith('Size:') and line.split()[-1] == video_size:
+            return 'mjpeg'
+    return 'yuyv422'
 
 
 class FFmpegRecorder:
@@ -35,8 +84,7 @@ class FFmpegRecorder:
 
         # Paths
         self.output_dir = Path(__file__).parent.parent / self.config['paths']['record_root']
-        self.hls_dir = "/tmp/picam_hls"
-        Path(self.hls_dir).mkdir(parents=True, exist_ok=True)
+        self.hls_dir = str(hls_dir(self.config))
 
         # Recording settings
         self.segment_seconds = self.config['storage']['segment_seconds']
@@ -54,20 +102,29 @@ class FFmpegRecorder:
 
         # FFmpeg process
         self.ffmpeg_process = None
-        self._stop_flag = False
+        # PID FFmpeg đang chạy, để lần khởi động sau dọn được process mồ côi
+        self.pid_file = Path("/tmp/picam_ffmpeg.pid")
+        # Event thay cho cờ bool: thread đang chờ được đánh thức ngay khi dừng
+        self._stop_event = threading.Event()
+        # FFmpeg ghi log thẳng vào file qua fd O_APPEND (mở 1 lần, giữ qua các
+        # lần restart) - Python không phải đọc/đệm từng dòng log nữa
+        self.ffmpeg_log = Path(self.config['paths'].get('ffmpeg_log', '/tmp/picam_ffmpeg.log'))
+        self._log_fd = None
+        self._log_start = 0  # offset đầu log của lần chạy hiện tại
 
         # Storage monitoring thread
         self._storage_monitor_thread = None
 
     def _storage_monitor_loop(self):
         """Monitor USB storage and update LED accordingly"""
-        while not self._stop_flag and self.is_running():
+        while not self._stop_event.is_set() and self.is_running():
             if not self.usb_manager.is_available():
                 self.led_control.blink(0.3)
-                print("⚠️ USB storage disconnected!")
+                log.warning("⚠️ USB storage disconnected!")
             else:
                 self.led_control.on()
-            time.sleep(2)
+            if self._stop_event.wait(2):
+                break
 
     def get_video_device(self):
         """Find available camera"""
@@ -78,7 +135,7 @@ class FFmpegRecorder:
         for i in range(10):
             dev = f'/dev/video{i}'
             if Path(dev).exists():
-                print(f"✅ Found camera: {dev}")
+                log.info("✅ Found camera: %s", dev)
                 return dev
 
         raise Exception("No camera found")
@@ -86,7 +143,7 @@ class FFmpegRecorder:
     def get_audio_device(self):
         """Get audio device in ALSA format with supported params"""
         if not self.config['audio'].get('enabled', False):
-            print("ℹ️ Audio disabled in config")
+            log.info("ℹ️ Audio disabled in config")
             return None
 
         test_devices = [
@@ -103,7 +160,7 @@ class FFmpegRecorder:
             {'rate': 48000, 'channels': 1},
         ]
 
-        print("🔍 Testing audio devices...")
+        log.info("🔍 Testing audio devices...")
         for alsa_device in test_devices:
             for params in test_params:
                 test_cmd = [
@@ -118,7 +175,7 @@ class FFmpegRecorder:
                 try:
                     result = subprocess.run(test_cmd, capture_output=True, timeout=3)
                     if result.returncode == 0:
-                        print(f"✅ Audio device verified: {alsa_device} ({params['channels']}ch @ {params['rate']}Hz)")
+                        log.info("✅ Audio device verified: %s (%sch @ %sHz)", alsa_device, params['channels'], params['rate'])
                         try:
                             Path('/tmp/audio_test.wav').unlink()
                         except:
@@ -130,115 +187,152 @@ class FFmpegRecorder:
                         }
                 except:
                     pass
-        print("⚠️ No working audio device found—falling back to video-only")
+        log.warning("⚠️ No working audio device found—falling back to video-only")
         return None
 
     def start_recording(self):
         """Start FFmpeg recording + HLS streaming"""
         
         if self.is_running():
-            print("⚠️ Already recording")
+            log.warning("⚠️ Already recording")
             return False
         
         # Check storage
         if not self.usb_manager.is_available():
-            print("❌ USB storage not available")
+            log.error("❌ USB storage not available")
             self.led_control.blink(0.5)
             return False
         
         if not self.usb_manager.has_enough_space():
-            print("⚠️ Low storage space, cleaning up...")
+            log.warning("⚠️ Low storage space, cleaning up...")
             self.usb_manager.cleanup_old_files()
             if not self.usb_manager.has_enough_space():
-                print("❌ Not enough storage space")
+                log.error("❌ Not enough storage space")
                 return False
         
-        # Clear old HLS files
-        for f in Path(self.hls_dir).glob("*.ts"):
-            try:
-                f.unlink()
-            except:
-                pass
-        for f in Path(self.hls_dir).glob("*.m3u8"):
-            try:
-                f.unlink()
-            except:
-                pass
+        self._prepare_hls_dir()
         
         # Get devices
         try:
             video_dev = self.get_video_device()
         except Exception as e:
-            print(f"❌ Device error: {e}")
+            log.error("❌ Device error: %s", e)
             return False
         
-        # Quick device lock check/kill
-        for dev in [video_dev]:
-            try:
-                if subprocess.run(['fuser', dev], capture_output=True).returncode == 0:
-                    print(f"⚠️ Device {dev} in use—killing processes")
-                    subprocess.run(['fuser', '-k', dev])
-            except:
-                pass
+        # FFmpeg cũ (recorder trước bị kill -9) còn giữ camera: chỉ dừng đúng
+        # process đã ghi trong pidfile, không fork fuser/kill bừa mọi thứ mở camera
+        self._kill_stale_ffmpeg()
         
         # Parse video settings
         video_size = self.config['video']['v4l2_format']
-        video_fps = self.config['video']['v4l2_fps']
+        video_fps = int(self.config['video']['v4l2_fps'])
+        # Segment HLS ngắn = độ trễ thấp; FFmpeg chỉ cắt segment tại keyframe
+        # nên GOP phải đúng bằng fps * hls_time, nếu không hls_time bị bỏ qua
+        hls_time = int(self.config['video'].get('hls_time', 1))
+        gop = video_fps * hls_time
+        # "auto" = dò v4l2-ctl, ưu tiên MJPEG nếu camera hỗ trợ ở video_size
+        input_format = self.config['video'].get('input_format', 'auto')
+        if input_format == 'auto':
+            input_format = _v4l2_input_format(video_dev, video_size)
+        log.info("📷 V4L2 input format: %s", input_format)
         
         # Build FFmpeg command
+        # Cờ độ trễ thấp là input option -> phải đứng TRƯỚC -i mới có tác dụng
         cmd = [
             'ffmpeg',
+            '-hide_banner', '-nostats',  # bỏ dòng tiến độ mỗi 0.5s khỏi log
+            '-fflags', 'nobuffer+discardcorrupt',
+            '-flags', 'low_delay',
+            '-probesize', '32',
+            '-analyzeduration', '0',
+            # Hàng đợi khung giữa thread đọc V4L2 và encoder: hấp thụ lúc encoder/mux
+            # chậm tạm thời thay vì rơi khung; PTS theo đồng hồ thực khi có khung rơi
+            '-thread_queue_size', '512',
+            '-use_wallclock_as_timestamps', '1',
             '-f', 'v4l2',
-            '-input_format', 'yuyv422',
+            '-input_format', input_format,
             '-video_size', video_size,
             '-framerate', str(video_fps),
             '-i', video_dev,
-            '-fflags', 'nobuffer',
-            '-flags', 'low_delay',
         ]
         
-        ## ◀️ THÊM MỚI: Logic tìm phông chữ cho timestamp
-        # Tìm một phông chữ. Cài đặt 'fonts-dejavu-core' nếu không có
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-        if not Path(font_path).exists():
-            font_path = "/usr/share/fonts/truetype/freefont/FreeSans.ttf" # Fallback
+        # Overlay timestamp chạy drawtext trên CPU (thêm 1 lần copy/khung hình trước
+        # encoder phần cứng) -> mặc định tắt; client đọc thời gian từ
+        # EXT-X-PROGRAM-DATE-TIME trong playlist
+        overlay_enabled = (self.config.get('overlay') or {}).get('enabled', False)
+        filter_string = None
+        if overlay_enabled:
+            ## ◀️ THÊM MỚI: Logic tìm phông chữ cho timestamp
+            # Tìm một phông chữ. Cài đặt 'fonts-dejavu-core' nếu không có
+            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
             if not Path(font_path).exists():
-                print("⚠️ WARNING: Không tìm thấy phông chữ. Overlay timestamp có thể thất bại.")
-                print("  ↳ Thử cài đặt: sudo apt-get install fonts-dejavu-core")
-                font_path = "default" # Để FFmpeg tự thử
-
-        # Định dạng timestamp, lưu ý \\: để escape dấu : cho FFmpeg
-        timestamp_format = '%{localtime\\:%Y-%m-%d %H\\:%M\\:%S}'
+                font_path = "/usr/share/fonts/truetype/freefont/FreeSans.ttf" # Fallback
+                if not Path(font_path).exists():
+                    log.warning("⚠️ WARNING: Không tìm thấy phông chữ. Overlay timestamp có thể thất bại.")
+                    log.warning("  ↳ Thử cài đặt: sudo apt-get install fonts-dejavu-core")
+                    font_path = "default" # Để FFmpeg tự thử
+
+            # Định dạng timestamp, lưu ý \\: để escape dấu : cho FFmpeg
+            timestamp_format = '%{localtime\\:%Y-%m-%d %H\\:%M\\:%S}'
         
-        filter_string = (
-            f"scale=640:480:flags=bicubic,"
-            f"drawtext=fontfile='{font_path}':"
-            f"text='%{{localtime\\:%Y-%m-%d %H\\\\\\:%M\\\\\\:%S}}':"
-            f"fontcolor=white:fontsize=20:box=1:boxcolor=black@0.5:"
-            f"boxborderw=5:x=(w-text_w-10):y=10,"
-            f"format=yuv420p"
-        )
-        ## ◀️ KẾT THÚC THAY ĐỔI
+            # Đổi sang yuv420p TRƯỚC drawtext: vẽ chữ trên plane 4:2:0 (ít byte/pixel
+            # hơn yuyv422) và ra đúng định dạng encoder nhận, không cần swscale thêm
+            filter_string = (
+                f"format=yuv420p,"
+                f"drawtext=fontfile='{font_path}':"
+                f"text='%{{localtime\\:%Y-%m-%d %H\\\\\\:%M\\\\\\:%S}}':"
+                f"fontcolor=white:fontsize=20:box=1:boxcolor=black@0.5:"
+                f"boxborderw=5:x=(w-text_w-10):y=10"
+            )
+            ## ◀️ KẾT THÚC THAY ĐỔI
         
         # Video codec settings
+        encoder = self.config['video'].get('encoder', 'h264_v4l2m2m')
+        if encoder == 'h264_v4l2m2m' and not _ffmpeg_has_encoder(encoder):
+            log.warning("⚠️ FFmpeg không có h264_v4l2m2m -> dùng libx264")
+            encoder = 'libx264'
+        if filter_string:
+            cmd.extend(['-vf', filter_string])
+        if encoder == 'h264_v4l2m2m':
+            # Encoder phần cứng VideoCore (V4L2 M2M) - không nhận -preset/-tune/-profile
+            cmd.extend([
+                '-c:v', 'h264_v4l2m2m',
+                '-threads', '1',  # encode chạy trên VideoCore, không cần thread CPU
+                '-b:v', '800k',
+                '-num_output_buffers', '32',
+                '-num_capture_buffers', '16',
+                '-g', str(gop),  # không hỗ trợ -force_key_frames
+            ])
+        else:
+            cmd.extend([
+                '-c:v', 'libx264',
+                '-preset', 'ultrafast',  # Thay đổi từ veryfast → ultrafast cho streaming
+                '-tune', 'zerolatency',
+                '-profile:v', 'baseline',  # Thay đổi từ main → baseline (tương thích tốt hơn)
+                '-level', '3.0',
+                '-g', str(gop),
+                '-keyint_min', str(gop),
+                '-force_key_frames', f'expr:gte(t,n_forced*{hls_time})',
+                '-sc_threshold', '0',
+                '-b:v', '800k',  # Giảm bitrate cho streaming mượt hơn
+                '-maxrate', '1000k',
+                '-bufsize', '2000k',
+            ])
+        # Độ trễ thấp: không B-frame, 1 khung tham chiếu, hàng đợi mux nhỏ
         cmd.extend([
-            '-vf', filter_string,
-            '-c:v', 'libx264',
-            '-preset', 'ultrafast',  # Thay đổi từ veryfast → ultrafast cho streaming
-            '-tune', 'zerolatency',
-            '-profile:v', 'baseline',  # Thay đổi từ main → baseline (tương thích tốt hơn)
-            '-level', '3.0',
-            '-g', str(video_fps * 2),
-            '-keyint_min', str(video_fps),
-            '-sc_threshold', '0',
-            '-b:v', '800k',  # Giảm bitrate cho streaming mượt hơn
-            '-maxrate', '1000k',
-            '-bufsize', '2000k',
             '-pix_fmt', 'yuv420p',
+            '-bf', '0',
+            '-refs', '1',
+            '-max_muxing_queue_size', '64',
         ])
         
         # Tee muxer setup
-        start_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        started = datetime.now()
+        start_time = started.strftime("%Y%m%d_%H%M%S")
+        # Tiền tố segment/init HLS riêng cho mỗi lần chạy, tới mili giây: restart
+        # nhanh (backoff 0.2s) trong cùng 1 giây không được trùng tên file đã
+        # phát cho client với Cache-Control immutable
+        hls_run = f"{start_time}_{started.microsecond // 1000:03d}"
         timestamp_pattern = f"{self.output_dir}/{start_time}_cam0_%03d.mp4"
         
         cmd.extend([
@@ -257,118 +351,268 @@ class FFmpegRecorder:
         #     f"hls_allow_cache=0:"
         #     f"hls_segment_filename={self.hls_dir}/segment_%03d.ts]{self.hls_dir}/stream.m3u8"
         # )
+        # fmp4 (CMAF): segment .m4s + 1 init .mp4, nhẹ hơn MPEG-TS (không có
+        # overhead gói 188 byte) và là nền cho LL-HLS; mpegts tương thích rộng hơn
+        if self.config['video'].get('hls_segment_type', 'mpegts') == 'fmp4':
+            hls_segment = (
+                f"hls_segment_type=fmp4:"
+                f"hls_fmp4_init_filename=init_{hls_run}.mp4:"
+                f"hls_segment_filename={self.hls_dir}/seg_{hls_run}_%05d.m4s"
+            )
+        else:
+            hls_segment = (
+                f"hls_segment_type=mpegts:"
+                f"hls_segment_filename={self.hls_dir}/seg_{hls_run}_%05d.ts"
+            )
         tee_output = (
             f"[f=mp4:movflags=+faststart]{self.output_dir}/{start_time}_cam0.mp4|"
-            f"[f=hls:hls_time=2:hls_list_size=5:"
-            f"hls_flags=delete_segments+independent_segments+append_list:"
-            f"hls_segment_type=mpegts:start_number=0:"
-            f"hls_allow_cache=0:"
-            f"hls_segment_filename={self.hls_dir}/segment_%03d.ts]{self.hls_dir}/stream.m3u8"
+            f"[f=hls:hls_time={hls_time}:hls_list_size=3:"
+            f"hls_flags=delete_segments+independent_segments+append_list+program_date_time:"
+            f"start_number=0:flush_packets=1:"
+            # Tên segment gắn thời điểm khởi động -> không bao giờ trùng giữa các lần
+            # restart, WebUI được phép cho client cache segment vĩnh viễn (immutable)
+            f"{hls_segment}]{self.hls_dir}/stream.m3u8"
         )
         
         cmd.append(tee_output)
         
-        print(f"🎬 Starting FFmpeg recording...")
-        print(f"  ↳ Video: {video_dev} ({video_size} @ {video_fps}fps)")
-        print(f"  ↳ Output: {self.output_dir}/*.mp4")
-        print(f"  ↳ HLS: {self.hls_dir}/stream.m3u8")
-        print(f"  ↳ Segment: {self.segment_seconds}s")
+        log.info("🎬 Starting FFmpeg recording...")
+        log.info("  ↳ Video: %s (%s @ %sfps)", video_dev, video_size, video_fps)
+        log.info("  ↳ Output: %s/*.mp4", self.output_dir)
+        log.info("  ↳ HLS: %s/stream.m3u8", self.hls_dir)
+        log.info("  ↳ Segment: %ss", self.segment_seconds)
+        log.info("  ↳ FFmpeg log: %s", self.ffmpeg_log)
         
         try:
+            # Ưu tiên CPU cho FFmpeg (nice âm cần root - service chạy User=root).
+            # Dùng `nice` bọc lệnh để mọi thread FFmpeg tạo ra đều thừa hưởng
+            ffmpeg_nice = int(self.config['video'].get('ffmpeg_nice', 0) or 0)
+            if ffmpeg_nice:
+                cmd = ['nice', '-n', str(ffmpeg_nice)] + cmd
+            # Ghim FFmpeg vào core riêng để không tranh cache với WebUI/recorder.
+            # Cũng bọc bằng `taskset` như `nice`: affinity đặt trước exec nên mọi
+            # thread (v4l2, encoder, tee/HLS) đều thừa hưởng; sched_setaffinity
+            # sau Popen chỉ trúng thread chính
+            ffmpeg_cpus = self.config['video'].get('ffmpeg_cpus') or []
+            if ffmpeg_cpus:
+                cpu_list = ','.join(str(c) for c in sorted(ffmpeg_cpus))
+                cmd = ['taskset', '-c', cpu_list] + cmd
+                log.info("  ↳ CPU affinity: %s", cpu_list)
+
             # Log command for debugging
             cmd_str = ' '.join(cmd)
-            print(f"  ↳ Command: {cmd_str[:200]}...")
+            log.info("  ↳ Command: %s...", cmd_str[:200])
             
+            log_fd = self._open_log()
+            self._log_start = os.lseek(log_fd, 0, os.SEEK_END)
             self.ffmpeg_process = subprocess.Popen(
                 cmd,
-                stdout=subprocess.PIPE,
+                stdout=log_fd,
                 stderr=subprocess.STDOUT,
                 stdin=subprocess.DEVNULL,
-                universal_newlines=True,
-                bufsize=1
+                # Session riêng: Ctrl-C ở terminal chỉ tới recorder, recorder tự
+                # dừng FFmpeg êm (SIGINT -> ghi trailer); không kế thừa fd nào
+                start_new_session=True,
+                close_fds=True,
             )
             
-            print(f"✅ FFmpeg started (PID: {self.ffmpeg_process.pid})")
-            
-            # Enhanced monitoring with queue
-            output_queue = queue.Queue()
-            def monitor_ffmpeg():
-                try:
-                    for line in iter(self.ffmpeg_process.stdout.readline, ''):
-                        output_queue.put(line)
-                        lower_line = line.lower()
-                        # ✅ FIX 5: Log HLS-specific errors
-                        if any(word in lower_line for word in ['error', 'failed', 'no such device', 
-                                                               'invalid argument', 'ioctl', 
-                                                               'demuxing', 'hls', 'segment']):
-                            print(f"⚠️ FFmpeg: {line.strip()}")
-                except:
-                    pass
-            
-            monitor_thread = threading.Thread(target=monitor_ffmpeg, daemon=True)
-            monitor_thread.start()
-            
-            # Drain output
-            def drain_output():
-                while self.is_running():
-                    try:
-                        line = output_queue.get(timeout=1)
-                        # Uncomment để xem full log: print(line.strip())
-                    except queue.Empty:
-                        continue
-            
-            drain_thread = threading.Thread(target=drain_output, daemon=True)
-            drain_thread.start()
+            log.info("✅ FFmpeg started (PID: %s)", self.ffmpeg_process.pid)
+            try:
+                self.pid_file.write_text(str(self.ffmpeg_process.pid))
+            except OSError as e:
+                log.warning("  ⚠️ Could not write %s: %s", self.pid_file, e)
             
             # Storage monitor
             self._storage_monitor_thread = threading.Thread(target=self._storage_monitor_loop, daemon=True)
             self._storage_monitor_thread.start()
             
-            # Wait for FFmpeg to start
-            time.sleep(3)  # Tăng từ 2→3s cho USB init
+            # Chờ playlist đầu tiên (thay cho sleep cố định 3s + 2s)
+            hls_ready = self._wait_for_hls_ready()
             
             if self.ffmpeg_process.poll() is not None:
-                print(f"❌ FFmpeg exited early: code {self.ffmpeg_process.returncode}")
+                log.error("❌ FFmpeg exited early: code %s", self.ffmpeg_process.returncode)
+                for line in self.ffmpeg_log_tail():
+                    log.error("  ↳ %s", line)
                 return False
             
             # ✅ FIX 6: Verify HLS files created
-            time.sleep(2)
-            if not Path(f"{self.hls_dir}/stream.m3u8").exists():
-                print(f"⚠️ Warning: stream.m3u8 not created yet")
+            if not hls_ready:
+                log.warning("⚠️ Warning: stream.m3u8 not created yet")
             else:
-                print(f"✅ HLS playlist created successfully")
+                log.info("✅ HLS playlist created successfully")
             
             self.led_control.on()
             return True
             
         except Exception as e:
-            print(f"❌ Failed to start FFmpeg: {e}")
-            traceback.print_exc()
+            log.exception("❌ Failed to start FFmpeg: %s", e)
             return False
 
+    def _prepare_hls_dir(self):
+        """Dọn segment/playlist cũ; chỉ tạo thư mục khi chưa có (tmpfs mất sau reboot)"""
+        try:
+            it = os.scandir(self.hls_dir)
+        except FileNotFoundError:
+            Path(self.hls_dir).mkdir(parents=True, exist_ok=True)
+            return
+        # 1 lần quét thư mục cho mọi file HLS (playlist, segment, init fmp4)
+        with it:
+            for entry in it:
+                if entry.name.endswith(_HLS_EXTS):
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+
+    def _open_log(self):
+        """fd log FFmpeg: O_APPEND để kernel tự nối cuối file, O_CLOEXEC để không rò sang process khác"""
+        self._rotate_log()
+        if self._log_fd is None:
+            self._log_fd = os.open(
+                str(self.ffmpeg_log),
+                os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC,
+                0o644,
+            )
+        return self._log_fd
+
+    def _rotate_log(self):
+        """Log quá FFMPEG_LOG_MAX_BYTES -> đổi tên thành .old, lần chạy này ghi file mới.
+        Chỉ làm lúc (re)start FFmpeg: -nostats nên log chỉ lớn dần qua nhiều lần restart"""
+        try:
+            # fstat trên fd đang giữ; chưa mở thì 1 lần stat, không exists() + stat()
+            st = os.fstat(self._log_fd) if self._log_fd is not None else os.stat(self.ffmpeg_log)
+        except FileNotFoundError:
+            return
+        if st.st_size <= FFMPEG_LOG_MAX_BYTES:
+            return
+        try:
+            os.replace(self.ffmpeg_log, f"{self.ffmpeg_log}.old")
+        except OSError as e:
+            log.warning("  ⚠️ Could not rotate %s: %s", self.ffmpeg_log, e)
+            return
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def ffmpeg_log_tail(self, lines=20, max_bytes=16384):
+        """N dòng log cuối của lần chạy FFmpeg hiện tại (để in khi FFmpeg chết)"""
+        try:
+            with open(self.ffmpeg_log, "rb") as f:
+                end = f.seek(0, os.SEEK_END)
+                f.seek(max(self._log_start, end - max_bytes))
+                data = f.read()
+        except OSError:
+            return []
+        return data.decode(errors="replace").splitlines()[-lines:]
+
+    def _kill_stale_ffmpeg(self, timeout=2.0):
+        """Dừng FFmpeg mồ côi ghi trong pid_file (chỉ khi cmdline đúng là FFmpeg của recorder)"""
+        try:
+            pid = int(self.pid_file.read_text())
+        except (OSError, ValueError):
+            return
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            cmdline = b""
+        # PID có thể đã bị tái sử dụng cho process khác -> đối chiếu cmdline
+        if b"ffmpeg" not in cmdline or self.hls_dir.encode() not in cmdline:
+            self.pid_file.unlink(missing_ok=True)
+            return
+        log.warning("⚠️ Stopping stale FFmpeg (PID: %s)", pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + timeout
+            while os.path.exists(f"/proc/{pid}") and time.monotonic() < deadline:
+                time.sleep(0.05)
+            if os.path.exists(f"/proc/{pid}"):
+                os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        except PermissionError as e:
+            log.warning("  ⚠️ Could not stop PID %s: %s", pid, e)
+        self.pid_file.unlink(missing_ok=True)
+
+    def _wait_for_hls_ready(self, timeout=5.0):
+        """Chờ FFmpeg ghi stream.m3u8 (size > 0); trả về False nếu quá hạn hoặc FFmpeg thoát"""
+        playlist = Path(self.hls_dir) / "stream.m3u8"
+        deadline = time.monotonic() + timeout
+
+        def playlist_ready():
+            try:
+                return playlist.stat().st_size > 0
+            except FileNotFoundError:
+                return False
+
+        # inotify: kernel đánh thức ngay khi FFmpeg ghi/rename playlist
+        try:
+            # Chỉ thức khi playlist ghi xong/rename vào chỗ, không thức theo từng write()
+            watch = DirWatch(self.hls_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError:
+            watch = None
+
+        if watch is not None:
+            with watch:
+                while time.monotonic() < deadline:
+                    if self._stop_event.is_set() or self.ffmpeg_process.poll() is not None:
+                        return False
+                    if playlist_ready():
+                        return True
+                    # Chờ tối đa 100ms mỗi vòng để vẫn phát hiện FFmpeg chết
+                    remaining = deadline - time.monotonic()
+                    watch.wait(max(0.0, min(remaining, 0.1)))
+            return False
+
+        # Fallback không có inotify: poll với backoff 10ms -> 20 -> 40 -> 80 -> tối đa 100ms
+        attempts = 0
+        while time.monotonic() < deadline:
+            if self.ffmpeg_process.poll() is not None:
+                return False
+            if playlist_ready():
+                return True
+            if self._stop_event.wait(min(0.01 * (1 << attempts), 0.1)):
+                return False
+            attempts += 1
+        return False
+
+    def _stop_storage_monitor(self):
+        """Đánh thức và chờ thread monitor USB thoát hẳn trước khi restart,
+        tránh thread cũ còn ngủ trong wait(2) sống lại song song thread mới"""
+        self._stop_event.set()
+        thread = self._storage_monitor_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=3)
+        self._storage_monitor_thread = None
+
     def stop_recording(self):
         """Stop FFmpeg recording"""
+        # FFmpeg tự chết thì vẫn phải dừng thread monitor của lần chạy đó
+        self._stop_storage_monitor()
         if not self.is_running():
             return
 
-        print("⏱ Stopping FFmpeg...")
-
-        self._stop_flag = True
+        log.info("⏱ Stopping FFmpeg...")
 
         try:
-            self.ffmpeg_process.terminate()
+            # SIGINT = 'q' của FFmpeg -> ghi trailer mp4/playlist rồi mới thoát
+            self.ffmpeg_process.send_signal(signal.SIGINT)
             self.ffmpeg_process.wait(timeout=10)
-            print("  ✅ FFmpeg stopped")
+            log.info("  ✅ FFmpeg stopped")
         except subprocess.TimeoutExpired:
-            print("  ⚠️ Timeout, force killing...")
+            log.warning("  ⚠️ Timeout, force killing...")
             self.ffmpeg_process.kill()
             self.ffmpeg_process.wait()
         except Exception as e:
-            print(f"  ⚠️ Error stopping FFmpeg: {e}")
+            log.warning("  ⚠️ Error stopping FFmpeg: %s", e)
 
         self.ffmpeg_process = None
+        try:
+            self.pid_file.unlink()
+        except OSError:
+            pass
         self.led_control.off()
-        print("  💡 LED off")
+        log.info("  💡 LED off")
 
     def is_running(self):
         """Check if FFmpeg is running"""
@@ -377,23 +621,52 @@ class FFmpegRecorder:
 
     def cleanup(self):
         """Cleanup resources"""
-        print("🧹 Cleanup...")
+        log.info("🧹 Cleanup...")
         self.stop_recording()
-        print("✅ Cleanup complete")
+        log.info("✅ Cleanup complete")
+
 
+# File do muxer HLS sinh ra (mpegts hoặc fmp4), dọn khi khởi động
+_HLS_EXTS = (".m3u8", ".ts", ".m4s", ".mp4")
+
+# Log FFmpeg lớn hơn mức này thì xoay vòng khi khởi động lại
+FFMPEG_LOG_MAX_BYTES = 10 * 1024 * 1024
 
 # Global recorder instance
 recorder = None
 
+# Chính sách tự khởi động lại FFmpeg
+RESTART_STABLE_SECONDS = 30     # chạy ít hơn mức này rồi chết -> tính là lỗi
+RESTART_MAX_FAILURES = 5        # quá số lỗi liên tiếp -> ngắt (circuit breaker)
+RESTART_COOLDOWN_SECONDS = 30
+
+def _wait_process_exit(proc):
+    """Chặn tới khi proc thoát; pidfd chỉ báo tin, không reap, nên signal handler
+    vẫn gọi proc.wait() được trong lúc đang chờ"""
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except ProcessLookupError:
+        return
+    except (AttributeError, OSError):
+        # Kernel < 5.3 / Python < 3.9: quay về poll mỗi 2 giây
+        time.sleep(2)
+        return
+    try:
+        select.select([fd], [], [])
+    finally:
+        os.close(fd)
+
+
 def signal_handler(signum, frame):
     """Handle shutdown signals"""
-    print("\n🛑 Shutting down...")
+    log.info("\n🛑 Shutting down...")
     if recorder:
         recorder.cleanup()
     sys.exit(0)
 
 
-if __name__ == "__main__":
+def main():
+    global recorder
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
@@ -401,38 +674,66 @@ if __name__ == "__main__":
         recorder = FFmpegRecorder()
 
         if recorder.start_recording():
-            print(f"📡 HLS stream available at: {recorder.hls_dir}/stream.m3u8")
-            print("  ↳ Test with: ffplay /tmp/picam_hls/stream.m3u8")
-            print("  ↳ Or web browser: http://your-pi-ip/live")
+            log.info("📡 HLS stream available at: %s/stream.m3u8", recorder.hls_dir)
+            log.info("  ↳ Test with: ffplay %s/stream.m3u8", recorder.hls_dir)
+            log.info("  ↳ Or web browser: http://your-pi-ip/live")
             
             # ◀️ ◀️ ◀️ THAY ĐỔI: Thêm vòng lặp tự động khởi động lại ◀️ ◀️ ◀️
+            # Backoff 0.2s -> 0.4 -> ... -> 10s; lỗi liên tiếp > MAX thì ngắt 30s
+            consec_failures = 0
+            started_at = time.monotonic()
             while True:
                 if not recorder.is_running():
-                    print("⚠️ FFmpeg process stopped unexpectedly! Restarting in 5s...")
-                    recorder.cleanup()  # Dọn dẹp tiến trình cũ
-                    time.sleep(5)
+                    if recorder.ffmpeg_process is not None:
+                        log.warning("⚠️ FFmpeg process stopped unexpectedly (code %s)",
+                                    recorder.ffmpeg_process.returncode)
+                        for line in recorder.ffmpeg_log_tail():
+                            log.warning("  ↳ %s", line)
+                        recorder.cleanup()  # Dọn dẹp tiến trình cũ
+                        recorder.ffmpeg_process = None
+
+                    # Chết ngay sau khi khởi động cũng tính là lỗi
+                    if time.monotonic() - started_at < RESTART_STABLE_SECONDS:
+                        consec_failures += 1
+                    else:
+                        consec_failures = 0
+
+                    if consec_failures > RESTART_MAX_FAILURES:
+                        log.error("🛑 %d lỗi liên tiếp - tạm dừng %ds", consec_failures, RESTART_COOLDOWN_SECONDS)
+                        delay = RESTART_COOLDOWN_SECONDS
+                        consec_failures = 0
+                    else:
+                        delay = min(0.2 * 2 ** consec_failures, 10.0)
+                    log.info("  ↳ Restarting in %.1fs...", delay)
+                    time.sleep(delay)
                     
-                    # Cập nhật lại _stop_flag trước khi khởi động lại
-                    recorder._stop_flag = False 
+                    # Reset _stop_event trước khi khởi động lại
+                    recorder._stop_event.clear() 
                     
+                    started_at = time.monotonic()
                     if not recorder.start_recording():
-                        print("❌ Failed to restart recording. Exiting.")
-                        sys.exit(1)
+                        # Vòng kiểm tra sau sẽ tính lỗi và lùi thời gian chờ
+                        log.error("❌ Failed to restart recording")
                     else:
-                        print("✅ FFmpeg restarted successfully.")
+                        log.info("✅ FFmpeg restarted successfully.")
                 
-                time.sleep(2) # Kiểm tra trạng thái mỗi 2 giây
+                # Ngủ tới đúng lúc FFmpeg thoát thay vì kiểm tra mỗi 2 giây
+                if recorder.is_running():
+                    _wait_process_exit(recorder.ffmpeg_process)
             # ◀️ ◀️ ◀️ KẾT THÚC THAY ĐỔI ◀️ ◀️ ◀️
             
         else:
-            print("❌ Failed to start recording")
+            log.error("❌ Failed to start recording")
             sys.exit(1)
 
     except KeyboardInterrupt:
-        print("\n🛑 Keyboard interrupt")
+        log.info("\n🛑 Keyboard interrupt")
         if recorder:
             recorder.cleanup()
     except Exception as e:
-        print(f"❌ Error: {e}")
-        traceback.print_exc()
-        sys.exit(1)
\ No newline at end of file
+        log.exception("❌ Error: %s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,13 +14,13 @@ from firmware.hal.gpio_leds import gpioLed
 from firmware.hal.gnss import GNSSModule
 from firmware.hal.rtc import rtcModule
 from firmware.hal.micro import Micro
-from firmware.config.config_loader import load
+from firmware.config.config_loader import load, hls_dir as resolve_hls_dir
 class PiStreamer:
     def __init__(self,
                  video_dev="/dev/video0",
                  audio_dev="hw:1,0",
                  output_dir="/media/ssd",
-                 hls_dir="/tmp/picam_hls",
+                 hls_dir=None,
                  segment_seconds=600,
                  led_pin=26):  # thêm tham số LED pin
         self.video_dev = video_dev
@@ -31,17 +31,21 @@ class PiStreamer:
         self.ffmpeg_process = None
         self.config_file = Path(__file__).parent.parent / 'config' / 'device_full.yaml'
         self.config = load(self.config_file)
+        if self.hls_dir is None:
+            self.hls_dir = str(resolve_hls_dir(self.config))
         # Khởi tạo LED với GPIO pin từ config
         self.led_control = gpioLed(self.config['gpio'].get('record_led', 26))
         self.led_thread = None
         self.led_running = False
-        
+
+        # Phải có trước initial(): initial() gán Micro() khi audio được bật
+        self.micro = None
         self.initial()
         self.overlay_file = "/tmp/overlay.txt"
+        # drawtext chạy trên CPU trước encoder -> chỉ bật khi cấu hình overlay.enabled
+        self.overlay_enabled = (self.config.get('overlay') or {}).get('enabled', False)
         self._stop_flag = False
         self._overlay_thread = None
-
-        self.micro = None
         # Khởi tạo RTC module
         try:
             self.rtc = rtcModule()
@@ -97,6 +101,13 @@ class PiStreamer:
             self.video_dev = self.config['video']['v4l2_device']
             self.video_size = self.config['video']['v4l2_format']
             self.video_fps = self.config['video']['v4l2_fps']
+            # Biến môi trường ghi đè config (thay cho các bản copy khác nhau của file này)
+            #   PICAM_ENC=h264_v4l2m2m|libx264  PICAM_FPS=25  PICAM_RES=640x480
+            self.encoder = os.environ.get("PICAM_ENC") or self.config['video'].get('encoder', 'h264_v4l2m2m')
+            self.video_fps = int(os.environ.get("PICAM_FPS") or self.video_fps)
+            self.video_size = os.environ.get("PICAM_RES") or self.video_size
+            # GOP = fps * hls_time: FFmpeg chỉ cắt segment HLS tại keyframe
+            self.hls_time = int(self.config['video'].get('hls_time', 1))
 
             # Cấu hình audio nếu được bật
             if self.config['capabilities'].get('audio', False):
@@ -172,7 +183,12 @@ class PiStreamer:
         hls_path = os.path.join(self.hls_dir, "stream.m3u8")
 
         # Tạo thư mục lưu segment theo thời gian
-        session_dir = datetime.now().strftime("session_%Y%m%d_%H%M%S")
+        started = datetime.now()
+        start_time = started.strftime("%Y%m%d_%H%M%S")
+        # Segment HLS được cache immutable -> tên phải khác nhau giữa các lần
+        # chạy kể cả khi khởi động lại trong cùng 1 giây
+        hls_run = f"{start_time}_{started.microsecond // 1000:03d}"
+        session_dir = f"session_{start_time}"
         record_dir = os.path.join(self.output_dir, session_dir)
         os.makedirs(record_dir, exist_ok=True)
         display_text = (
@@ -189,14 +205,16 @@ class PiStreamer:
         cmd = [
             "ffmpeg",
             "-hide_banner", "-loglevel", "error",
+            "-thread_queue_size", "512",
+            "-use_wallclock_as_timestamps", "1",
             "-f", "v4l2",
-            "-framerate", "25",
-            "-video_size", "640x480",
+            "-framerate", str(self.video_fps),
+            "-video_size", self.video_size,
             "-i", self.video_dev,
         ]
 
         # --- Optional audio part ---
-        if self.micro.get_first_available_device():  # nếu có audio_dev
+        if self.micro and self.micro.get_first_available_device():  # nếu có audio_dev
             cmd += [
                 "-f", "alsa",
                 "-ac", "1",
@@ -212,19 +230,36 @@ class PiStreamer:
             map_args = ["-map", "0:v"]
 
         # --- Video encoding ---
-        cmd += [
-            "-c:v", "libx264",
-            "-preset", "veryfast",
-            "-crf", "23",
-            "-vf", display_text,
-        ]
+        if self.encoder == 'h264_v4l2m2m':
+            # Encoder phần cứng VideoCore (V4L2 M2M) - không nhận -preset/-crf
+            cmd += [
+                "-c:v", "h264_v4l2m2m",
+                "-b:v", "1500k",
+                "-num_output_buffers", "32",
+                "-num_capture_buffers", "16",
+            ]
+        else:
+            # Keyframe cố định đúng ranh giới segment: không IDR thừa khi đổi cảnh,
+            # segment HLS luôn dài đúng hls_time
+            cmd += [
+                "-c:v", "libx264",
+                "-preset", "veryfast",
+                "-crf", "23",
+                "-keyint_min", str(self.video_fps * self.hls_time),
+                "-sc_threshold", "0",
+                "-force_key_frames", f"expr:gte(t,n_forced*{self.hls_time})",
+            ]
+        cmd += ["-g", str(self.video_fps * self.hls_time), "-pix_fmt", "yuv420p"]
+        if self.overlay_enabled:
+            cmd += ["-vf", display_text]
 
         # --- Mapping and output ---
         cmd += map_args + [
             "-f", "tee",
             f"[f=segment:strftime=1:segment_time={self.segment_seconds}:reset_timestamps=1]"
             f"'{record_dir}/%Y%m%d_%H%M%S_cam0.mp4'|"
-            f"[f=hls:hls_time=4:hls_list_size=5:hls_flags=delete_segments]{hls_path}"
+            f"[f=hls:hls_time={self.hls_time}:hls_list_size=3:hls_flags=delete_segments:"
+            f"hls_segment_filename={self.hls_dir}/seg_{hls_run}_%05d.ts]{hls_path}"
         ]
         print(cmd)
         return cmd
@@ -247,14 +282,15 @@ class PiStreamer:
 
         cmd = self._build_ffmpeg_cmd()
         self._stop_flag = False
-        self._overlay_thread = threading.Thread(target=self._update_overlay_file, daemon=True)
-        self._overlay_thread.start()
+        if self.overlay_enabled:
+            self._overlay_thread = threading.Thread(target=self._update_overlay_file, daemon=True)
+            self._overlay_thread.start()
         print(f"🚀 Bắt đầu ghi và stream (mỗi {self.segment_seconds}s lưu 1 file)...")
         print("   ↳ Lưu tại:", self.output_dir)
         print("   ↳ HLS tại:", self.hls_dir)
         print("   ↳ URL: http://<ip-pi>:8080/hls/stream.m3u8")
 
-        self.ffmpeg_process = subprocess.Popen(cmd)
+        self.ffmpeg_process = subprocess.Popen(cmd, start_new_session=True, close_fds=True)
         time.sleep(2)
 
         if self.ffmpeg_process.poll() is None:
@@ -294,6 +330,7 @@ class PiStreamer:
                 self.ffmpeg_process.wait(timeout=5)
             except subprocess.TimeoutExpired:
                 self.ffmpeg_process.kill()
+                self.ffmpeg_process.wait()  # reap, không để lại zombie
             # Tắt LED khi dừng ghi
             self.led_control.off()
             print("✅ Đã dừng.")
@@ -307,6 +344,7 @@ class PiStreamer:
                 self.ffmpeg_process.wait(timeout=5)
             except subprocess.TimeoutExpired:
                 self.ffmpeg_process.kill()
+                self.ffmpeg_process.wait()  # reap, không để lại zombie
         self._stop_flag = True
         if self._overlay_thread:
             self._overlay_thread.join(timeout=2)
@@ -339,7 +377,8 @@ def signal_handler(signum, frame):
         recorder.cleanup()
     sys.exit(0)
 
-if __name__ == "__main__":
+def main():
+    global recorder
     # Đăng ký handler cho SIGINT và SIGTERM
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -384,3 +423,7 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"❌ Lỗi chương trình: {e}")
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
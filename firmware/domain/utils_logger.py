@@ -0,0 +1,31 @@
+"""
+Logger dùng chung: record đi qua QueueHandler, 1 thread QueueListener ghi ra stdout
+-> các thread nóng (monitor USB, vòng giám sát FFmpeg...) chỉ put vào queue, không tự write()/flush
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+_queue = None
+_listener = None
+
+
+def get_logger(name, level=logging.INFO):
+    global _queue, _listener
+    if _listener is None:
+        _queue = queue.SimpleQueue()
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _listener = logging.handlers.QueueListener(_queue, handler)
+        _listener.start()
+        # Xả hết log còn trong queue khi thoát (kể cả sys.exit từ signal handler)
+        atexit.register(_listener.stop)
+
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.handlers.QueueHandler(_queue))
+        logger.setLevel(level)
+        logger.propagate = False
+    return logger
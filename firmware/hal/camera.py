@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
+import atexit
+import fcntl
+import shutil
+import signal
 import subprocess
 import threading
 import numpy as np
 import time
 import sys
-import ffmpeg
+
+# fcntl.F_SETPIPE_SZ chỉ có từ Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+PIPE_SIZE = 1 << 20
 
 class FFmpegCamera:
     def __init__(self, device="/dev/video0", width=640, height=480, fps=25, pix_fmt="bgr24", ffmpeg_bin="ffmpeg"):
@@ -13,11 +20,27 @@ class FFmpegCamera:
         self.height = height
         self.fps = fps
         self.pix_fmt = pix_fmt
-        self.ffmpeg_bin = ffmpeg_bin
+        # Đường dẫn tuyệt đối: subprocess không phải dò PATH mỗi lần start()
+        self.ffmpeg_bin = shutil.which(ffmpeg_bin) or ffmpeg_bin
         self.proc = None
         self._stop = False
         self._stderr_thread = None
+        self._stdout_raw = None
         self.frame_size = self.width * self.height * 3  # BGR24
+        # Lệnh FFmpeg cố định cho mỗi camera -> dựng 1 lần, không cần ffmpeg-python
+        self.cmd = (
+            self.ffmpeg_bin,
+            '-hide_banner', '-loglevel', 'warning',
+            '-f', 'v4l2',
+            '-framerate', str(self.fps),
+            '-video_size', f'{self.width}x{self.height}',
+            '-i', self.device,
+            '-threads', '1',  # chỉ đổi pixel format, 1 thread là đủ
+            '-f', 'rawvideo',
+            '-pix_fmt', self.pix_fmt,
+            '-vcodec', 'rawvideo',
+            'pipe:',
+        )
 
     def _drain_stderr(self, stream):
         try:
@@ -33,20 +56,21 @@ class FFmpegCamera:
             return
         
         try:
-            # Use ffmpeg-python library to create camera capture process
-            self.proc = (
-                ffmpeg
-                .input(self.device, 
-                       format='v4l2',
-                       framerate=self.fps,
-                       video_size=f'{self.width}x{self.height}')
-                .output('pipe:', 
-                        format='rawvideo',
-                        pix_fmt=self.pix_fmt,
-                        vcodec='rawvideo')
-                .global_args('-hide_banner', '-loglevel', 'warning')
-                .run_async(pipe_stdout=True, pipe_stderr=True, bufsize=10**7)
+            self.proc = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
             )
+            # Frame đọc thẳng từ fd (FileIO) vào buffer của frame, không qua
+            # lớp BufferedReader -> bỏ 1 lần copy và buffer 10 MB của bufsize cũ
+            self._stdout_raw = self.proc.stdout.raw
+            # Pipe mặc định 64 KiB < 1 frame -> nâng lên 1 MiB để FFmpeg ghi cả frame
+            # mà không bị chặn, và mỗi lần read lấy được nhiều dữ liệu hơn
+            try:
+                fcntl.fcntl(self.proc.stdout.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass
             
             # Start stderr monitoring thread
             self._stderr_thread = threading.Thread(
@@ -56,6 +80,9 @@ class FFmpegCamera:
             )
             self._stderr_thread.start()
             self._stop = False
+            # Tiến trình Python thoát mà chưa gọi stop() -> vẫn dừng FFmpeg êm,
+            # không để FFmpeg mồ côi giữ /dev/video0 (Device or resource busy)
+            atexit.register(self.stop)
             
         except Exception as e:
             print(f"✗ Failed to start camera: {e}")
@@ -65,13 +92,17 @@ class FFmpegCamera:
     def read_frame(self, timeout=None):
         if not self.proc:
             return None
-        buf = b''
+        # Đọc thẳng vào 1 bytearray cấp sẵn qua memoryview -> không nối bytes (O(n²))
+        # Mỗi frame 1 buffer mới vì mảng numpy trả về dùng chung bộ nhớ với nó
+        buf = bytearray(self.frame_size)
+        mv = memoryview(buf)
+        pos = 0
         start = time.time()
-        while len(buf) < self.frame_size:
-            chunk = self.proc.stdout.read(self.frame_size - len(buf))
-            if not chunk:
+        while pos < self.frame_size:
+            n = self._stdout_raw.readinto(mv[pos:])
+            if not n:
                 return None
-            buf += chunk
+            pos += n
             if timeout is not None and (time.time() - start) > timeout:
                 return None
         arr = np.frombuffer(buf, dtype=np.uint8).reshape((self.height, self.width, 3))
@@ -79,6 +110,7 @@ class FFmpegCamera:
 
     def stop(self):
         self._stop = True
+        atexit.unregister(self.stop)
         if self.proc:
             try:
                 # Close stdout pipe to signal FFmpeg to stop
@@ -86,8 +118,8 @@ class FFmpegCamera:
             except:
                 pass
             try:
-                # Give FFmpeg time to cleanup gracefully
-                self.proc.terminate()
+                # SIGINT để FFmpeg tự dọn dẹp và thoát sạch
+                self.proc.send_signal(signal.SIGINT)
                 self.proc.wait(timeout=2)
             except subprocess.TimeoutExpired:
                 # Force kill if it doesn't terminate
@@ -99,4 +131,8 @@ class FFmpegCamera:
             except:
                 pass
             finally:
+                try:
+                    self.proc.stderr.close()
+                except Exception:
+                    pass
                 self.proc = None
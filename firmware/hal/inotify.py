@@ -0,0 +1,78 @@
+"""
+inotify tối giản qua ctypes (không cần pyinotify): chờ sự kiện file trong 1 thư mục
+ngay trong kernel thay vì poll stat()/glob() theo chu kỳ
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify not supported on this platform")
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+class DirWatch:
+    """Theo dõi 1 thư mục; wait() trả về danh sách (mask, tên file) hoặc [] khi hết timeout"""
+
+    def __init__(self, path, mask=IN_CREATE | IN_MODIFY | IN_MOVED_TO):
+        libc = _load_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            self.fd = -1
+            raise OSError(err, os.strerror(err), str(path))
+
+    def wait(self, timeout=None):
+        if self.fd < 0:
+            return []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(buf):
+            _, mask, _, name_len = _EVENT.unpack_from(buf, pos)
+            pos += _EVENT.size
+            name = buf[pos:pos + name_len].rstrip(b"\0").decode(errors="ignore")
+            pos += name_len
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -8,6 +8,12 @@ def create_app(cfg: dict):
     static_folder = Path(__file__).parent / 'static'
     app = Flask(__name__, static_folder=str(static_folder), static_url_path='/static')
     app.config["PICAM_CFG"] = cfg or {}
+    # Chỉ bật khi WebUI đứng sau proxy hiểu X-Sendfile: Flask chỉ trả header,
+    # proxy gửi file (send_from_directory của /download cũng dùng cờ này)
+    web_cfg = (cfg or {}).get("webui") or {}
+    app.config["USE_X_SENDFILE"] = bool(web_cfg.get("x_sendfile", False))
+    # Sau nginx (nginx/picam.conf): trả X-Accel-Redirect, nginx gửi segment bằng sendfile
+    app.config["PICAM_X_ACCEL"] = bool(web_cfg.get("x_accel", False))
 
     # Đảm bảo thư mục ghi hình tồn tại
     record_root = Path(((cfg.get("paths") or {}).get("record_root") or "/media/ssd/picam"))
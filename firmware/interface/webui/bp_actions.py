@@ -2,7 +2,6 @@ from __future__ import annotations
 from flask import Blueprint, request, redirect
 import subprocess
 from pathlib import Path
-import os
 from .helpers import cfg_get, set_recording
 
 bp = Blueprint("actions", __name__)
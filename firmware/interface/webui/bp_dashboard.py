@@ -1,15 +1,20 @@
 from __future__ import annotations
-from flask import Blueprint, current_app, render_template_string, send_from_directory, abort, request
+from flask import Blueprint, current_app, render_template
 from pathlib import Path
-from .helpers import cfg_get, leds_status, iface_is_up, rec_is_active, disk_info, list_media, time_info, hw_inventory
-import re
+from .helpers import static_sri, cfg_get, leds_status, iface_is_up, rec_is_active, disk_info, list_media, time_info, hw_inventory
 
 bp = Blueprint("dashboard", __name__)
 
-# -----------------------------------------------------------
-# HLS PATH CONFIG
-# -----------------------------------------------------------
-HLS_DIR = Path("/tmp/picam_hls")
+# Template dịch 1 lần mỗi app; render_template_string parse + compile lại mỗi request.
+# render_template nhận thẳng Template nên vẫn có context processor (url_for, request...)
+_compiled: dict = {}
+
+def _template(source: str):
+    env = current_app.jinja_env
+    tpl = _compiled.get((id(env), source))
+    if tpl is None:
+        tpl = _compiled[(id(env), source)] = env.from_string(source)
+    return tpl
 
 # -----------------------------------------------------------
 # CSS STYLE (Thêm mới)
@@ -324,9 +329,13 @@ _HTML = r"""
     </div>
 
     <div id="liveView" class="tab-content active">
-      <video id="videoStream" controls autoplay muted
-        style="width:100%; aspect-ratio: 4/3; max-height:70vh; background:#000; border-radius:8px;">
-      </video>
+      <div style="position:relative;">
+        <video id="videoStream" controls autoplay muted
+          style="width:100%; aspect-ratio: 4/3; max-height:70vh; background:#000; border-radius:8px;">
+        </video>
+        <div id="streamTs" style="position:absolute; top:10px; right:10px; padding:2px 6px; border-radius:4px;
+             background:rgba(0,0,0,.5); color:#fff; font:14px monospace; pointer-events:none;"></div>
+      </div>
       <small>HLS stream (~{{video_fps}}fps). Real-time từ Flask route <code>/hls/stream.m3u8</code>.</small>
     </div>
 
@@ -436,14 +445,27 @@ _FRAME = r"""
 <style>
 {{style|safe}}
 </style>
-<script src="/static/hls.min.js"></script>
+<link rel="preload" as="fetch" href="/hls/stream.m3u8" crossorigin="anonymous">
+<script src="/static/hls.min.js" integrity="{{hls_sri}}" crossorigin="anonymous"></script>
 <script>
 document.addEventListener('DOMContentLoaded', function() {
   const video = document.getElementById('videoStream');
   const hlsUrl = '/hls/stream.m3u8';
+  let hls = null;
+
+  // Giờ trên khung hình do trình duyệt vẽ từ EXT-X-PROGRAM-DATE-TIME (FFmpeg không drawtext)
+  const tsEl = document.getElementById('streamTs');
+  setInterval(() => {
+    let d = hls && hls.playingDate;
+    if (!d) {
+      const start = video.getStartDate ? video.getStartDate().getTime() : NaN;
+      d = isNaN(start) ? new Date() : new Date(start + video.currentTime * 1000);
+    }
+    tsEl.textContent = d.toLocaleString();
+  }, 1000);
 
   if (Hls.isSupported()) {
-      const hls = new Hls({ maxBufferLength: 4, maxMaxBufferLength: 10, lowLatencyMode: true });
+      hls = new Hls({ maxBufferLength: 2, maxMaxBufferLength: 4, lowLatencyMode: true });
       hls.loadSource(hlsUrl);
       hls.attachMedia(video);
       hls.on(Hls.Events.MANIFEST_PARSED, () => video.play().catch(e => console.log('Autoplay blocked')));
@@ -504,7 +526,7 @@ def index():
 
     video_fps = cfg_get("video.fps", 15)
 
-    body = render_template_string(_HTML,
+    body = render_template(_template(_HTML),
         dev=dev, leds=leds_status(), recording=rec_is_active(),
         wifi_up=iface_is_up(cfg_get("wifi.iface","wlan0")),
         video_fps=video_fps, storage=storage_info,
@@ -512,38 +534,5 @@ def index():
     )
 
     # <--- SỬA ĐỔI: Truyền biến _STYLE vào template
-    return render_template_string(_FRAME, body=body, style=_STYLE)
-
+    return render_template(_template(_FRAME), body=body, style=_STYLE, hls_sri=static_sri("hls.min.js"))
 
-# -----------------------------------------------------------
-# ROUTE PHỤC VỤ FILE HLS
-# -----------------------------------------------------------
-# <--- SỬA ĐỔI: Bỏ comment cho route này
-@bp.route("/hls/<path:filename>")
-def serve_hls(filename):
-    """Phục vụ file HLS (.m3u8, .ts)"""
-    # Ngăn chặn Path Traversal
-    if re.search(r"(\.\.|%2e%2e|%00)", filename):
-        current_app.logger.warning(f"HLS: Invalid path attempt: {filename}")
-        abort(400)
-    
-    file_path = HLS_DIR.joinpath(filename).resolve()
-    
-    # Kiểm tra xem file có thực sự nằm trong HLS_DIR không
-    if not file_path.exists() or not str(file_path).startswith(str(HLS_DIR.resolve())):
-        current_app.logger.warning(f"HLS: File not found or access denied: {file_path}")
-        abort(404)
-        
-    if filename.endswith(".m3u8"):
-        mime = "application/vnd.apple.mpegurl"
-    elif filename.endswith(".ts"):
-        mime = "video/mp2t"
-    else:
-        mime = "application/octet-stream"
-    
-    # Thêm header để tránh cache
-    response = send_from_directory(HLS_DIR, filename, mimetype=mime)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    return response
\ No newline at end of file
@@ -1,8 +1,18 @@
 from __future__ import annotations
-from flask import Blueprint, Response, request, abort, render_template_string, send_from_directory
+from flask import Blueprint, Response, current_app, request, abort
+from werkzeug.wsgi import wrap_file
 from functools import wraps
-from pathlib import Path
+import gzip
+import hashlib
+import os
 import re
+import stat
+import threading
+import time
+from firmware.hal.inotify import DirWatch, IN_CLOSE_WRITE, IN_MOVED_TO
+from .helpers import HLS_DIR, rec_is_active, static_sri
+
+__all__ = ("bp",)
 
 # ============================================================
 # CONFIG
@@ -10,21 +20,95 @@ import re
 
 bp = Blueprint("liveview", __name__)
 
-# Thư mục chứa các file HLS (do FFmpeg sinh ra)
-HLS_DIR = Path("/tmp/picam_hls")
+# Playlist rỗng trả về khi recorder chưa sinh stream.m3u8 -> player tự poll lại
+_EMPTY_PLAYLIST = (
+    b"#EXTM3U\n"
+    b"#EXT-X-VERSION:3\n"
+    b"#EXT-X-TARGETDURATION:1\n"
+    b"#EXT-X-MEDIA-SEQUENCE:0\n"
+)
+# Cache nội dung playlist theo (inode, mtime, size): FFmpeg ghi .tmp rồi rename,
+# nên chỉ cần 1 lần stat; đọc lại file khi playlist thực sự đổi.
+# Trong _M3U8_TTL giây trả luôn bytes đã cache, nhiều client poll cùng lúc
+# chỉ tốn ~4 lần stat/giây (lock gom các request đến đồng thời)
+_M3U8_TTL = 0.25
+_m3u8_cache: dict = {}
+_m3u8_lock = threading.Lock()
+# Playlist là text lặp lại nhiều, gzip giảm ~80% byte mỗi lần client poll.
+# Nén 1 lần cho mỗi bản playlist mới (path -> (bytes gốc, bytes gzip)),
+# mọi client dùng chung. Segment .ts/.m4s đã nén H.264 -> không bao giờ gzip
+_GZIP_MIN_SIZE = 200
+_m3u8_gzip: dict = {}
+
+# Blocking playlist reload (kiểu LL-HLS ?_HLS_msn=N): giữ request tới khi
+# playlist có segment N. Thread inotify tăng _playlist_seq mỗi lần FFmpeg
+# ghi playlist mới và đánh thức các request đang chờ
+_HLS_BLOCK_TIMEOUT = 3.0
+_MEDIA_SEQ_RE = re.compile(rb"#EXT-X-MEDIA-SEQUENCE:(\d+)")
+# Báo cho player (hls.js lowLatencyMode) biết server hỗ trợ ?_HLS_msn; chỉ chèn
+# khi có inotify, vì không có watcher thì request chỉ được trả ngay
+_SERVER_CONTROL = b"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES\n"
+_playlist_seq = 0
+_playlist_cv = threading.Condition()
+# Recorder đang chạy nhưng chưa có playlist: chờ event inotify (FFmpeg ghi
+# xong/rename playlist) thay vì trả playlist rỗng bắt client poll lại
+_HLS_READY_TIMEOUT = 2.0
+_hls_ready = threading.Event()
+_watcher_started = None  # None = chưa thử, True/False = đã chạy được hay không
+# WebUI có thể lên trước recorder (HLS_DIR chưa tồn tại): không ghi nhớ lỗi
+# này, thử lại sau _WATCHER_RETRY giây
+_WATCHER_RETRY = 1.0
+_watcher_retry_at = 0.0
+
+# Segment .ts: tên gắn thời điểm khởi động recorder (seg_<start>_<ms>_NNNNN.ts, init_<start>_<ms>.mp4),
+# không bao giờ bị ghi đè -> client/proxy cache vĩnh viễn, khỏi revalidate
+_SEGMENT_CACHE = "public, max-age=31536000, immutable"
+# Player nhúng từ origin khác (app, dashboard khác cổng) không cần preflight
+_CORS = {"Access-Control-Allow-Origin": "*"}
+
+# HLS_DIR đã resolve symlink 1 lần lúc import, dùng cho kiểm tra chứa file
+_HLS_ROOT = HLS_DIR.resolve()
+
+# location internal của nginx trỏ vào HLS_DIR (xem nginx/picam.conf)
+_X_ACCEL_PREFIX = "/internal-hls/"
+
+_M3U8_MIME = "application/vnd.apple.mpegurl"
+_HLS_MIME = {
+    ".m3u8": _M3U8_MIME,
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+
+_NO_CACHE = {
+    "Cache-Control": "no-cache, no-store, must-revalidate",
+    "Pragma": "no-cache",
+    "Expires": "0",
+    **_CORS,
+}
+_NO_CACHE_GZIP = {**_NO_CACHE, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+_NO_CACHE_VARY = {**_NO_CACHE, "Vary": "Accept-Encoding"}
 
 # ============================================================
 # SECURITY VALIDATION
 # ============================================================
 
+_BAD_PATH_PARTS = ("..", "%2e%2e", "%252e%252e", "'", '"', ";")
+# Biên dịch 1 lần lúc import: ký tự điều khiển và chuỗi \xNN
+_BAD_PATH_RE = re.compile(r'[\x00-\x1f\x7f]|\\x[0-9a-f]{2}', re.IGNORECASE)
+# Path chỉ gồm các ký tự này và không có ".." (vd /hls/segment_047.ts) thì
+# không thể khớp các mẫu trên -> bỏ qua hẳn bước dò chuỗi/regex
+_SAFE_PATH_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/_-.")
+
 def validate_request(f):
     """Decorator để kiểm tra yêu cầu đầu vào tránh path traversal"""
     @wraps(f)
     def decorated(*args, **kwargs):
         path = request.path
-        # Regex lọc các chuỗi độc hại
-        if re.search(r'(\.\.|%2e%2e|%252e%252e|[\x00-\x1f\x7f]|[\'";]|\\x[0-9a-f]{2})', path, re.I):
-            abort(400, "Invalid characters in request path")
+        if ".." in path or not _SAFE_PATH_CHARS.issuperset(path):
+            low = path.lower()
+            if any(bad in low for bad in _BAD_PATH_PARTS) or _BAD_PATH_RE.search(path):
+                abort(400, "Invalid characters in request path")
         return f(*args, **kwargs)
     return decorated
 
@@ -32,22 +116,24 @@ def validate_request(f):
 # ROUTES
 # ============================================================
 
-@bp.get("/live")
-@validate_request
-def live_video():
-    """Giao diện HTML để xem video HLS"""
-    hls_url = "/hls/stream.m3u8"
-    html = f"""
+# Trang /live không có biến theo request -> dựng HTML 1 lần lúc import,
+# ETag cố định để trình duyệt tải lại nhận 304
+_LIVE_HLS_URL = "/hls/stream.m3u8"
+_LIVE_HTML = f"""
     <!DOCTYPE html>
     <html>
     <head>
         <title>Live Camera Stream</title>
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <script src="/static/hls.min.js"></script>
+        <link rel="preload" as="fetch" href="{_LIVE_HLS_URL}" crossorigin="anonymous">
+        <script src="/static/hls.min.js" integrity="{static_sri('hls.min.js')}" crossorigin="anonymous"></script>
         <style>
             body {{ margin: 0; background: #000; text-align: center; font-family: sans-serif; color: #eee; }}
             h2 {{ margin: 20px 0 10px; font-size: 24px; }}
-            #videoStream {{ width: 90%; max-width: 1280px; max-height: 80vh; border-radius: 8px; margin: 20px auto; display: block; }}
+            #player {{ position: relative; width: 90%; max-width: 1280px; margin: 20px auto; }}
+            #videoStream {{ width: 100%; max-height: 80vh; border-radius: 8px; display: block; }}
+            #ts {{ position: absolute; top: 10px; right: 10px; padding: 2px 6px; border-radius: 4px;
+                   background: rgba(0,0,0,.5); color: #fff; font: 16px monospace; pointer-events: none; }}
             .status {{ color: #0f0; font-size: 14px; }}
             .error {{ color: #f00; font-size: 14px; }}
         </style>
@@ -55,15 +141,28 @@ def live_video():
     <body>
         <h2>📷 Live Camera Stream (HLS)</h2>
         <p id="status">● Connecting...</p>
-        <video id="videoStream" controls autoplay muted></video>
-        <p style="font-size:12px;color:#999;">HLS served from /tmp/picam_hls</p>
+        <div id="player">
+            <video id="videoStream" controls autoplay muted></video>
+            <div id="ts"></div>
+        </div>
+        <p style="font-size:12px;color:#999;">HLS served from {HLS_DIR}</p>
 
         <script>
             const statusEl = document.getElementById('status');
             const video = document.getElementById('videoStream');
-            const hlsUrl = '{hls_url}';
+            const hlsUrl = '{_LIVE_HLS_URL}';
+            let hls = null;
+            // Giờ hiển thị do trình duyệt vẽ (FFmpeg không drawtext): lấy từ
+            // EXT-X-PROGRAM-DATE-TIME của khung đang phát, chưa có thì giờ máy khách
+            const tsEl = document.getElementById('ts');
+            function streamDate() {{
+                if (hls && hls.playingDate) return hls.playingDate;
+                const start = video.getStartDate ? video.getStartDate().getTime() : NaN;
+                return isNaN(start) ? new Date() : new Date(start + video.currentTime * 1000);
+            }}
+            setInterval(() => {{ tsEl.textContent = streamDate().toLocaleString(); }}, 1000);
             if (Hls.isSupported()) {{
-                const hls = new Hls({{ maxBufferLength: 4, maxMaxBufferLength: 10, lowLatencyMode: true }});
+                hls = new Hls({{ maxBufferLength: 2, maxMaxBufferLength: 4, lowLatencyMode: true }});
                 hls.loadSource(hlsUrl);
                 hls.attachMedia(video);
                 hls.on(Hls.Events.MANIFEST_PARSED, function() {{
@@ -88,24 +187,224 @@ def live_video():
         </script>
     </body>
     </html>
-    """
-    return render_template_string(html)
+    """.encode("utf-8")
+_LIVE_ETAG = hashlib.md5(_LIVE_HTML).hexdigest()
+
+
+@bp.get("/live")
+@validate_request
+def live_video():
+    """Giao diện HTML để xem video HLS"""
+    response = Response(_LIVE_HTML, mimetype="text/html")
+    response.set_etag(_LIVE_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+
+def _read_playlist(path, fresh=False) -> bytes:
+    """Đọc playlist, dùng lại bytes đã cache nếu còn trong TTL hoặc file chưa đổi.
+    fresh=True: bỏ qua TTL, luôn stat lại và so (inode, mtime, size)"""
+    hit = _m3u8_cache.get(path)
+    if not fresh and hit is not None and time.monotonic() - hit[2] < _M3U8_TTL:
+        return hit[1]
+    with _m3u8_lock:
+        # Request khác có thể vừa làm mới trong lúc chờ lock
+        hit = _m3u8_cache.get(path)
+        now = time.monotonic()
+        if not fresh and hit is not None and now - hit[2] < _M3U8_TTL:
+            return hit[1]
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if hit is not None and hit[0] == key:
+            data = hit[1]
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+            if _watcher_started:
+                data = data.replace(b"#EXTM3U\n", b"#EXTM3U\n" + _SERVER_CONTROL, 1)
+        _m3u8_cache[path] = (key, data, now)
+        return data
+
+
+def _load_playlist(path, fresh=False) -> bytes:
+    try:
+        return _read_playlist(path, fresh)
+    except OSError:
+        return _EMPTY_PLAYLIST
+
+
+def _gzip_playlist(path, data: bytes) -> bytes:
+    """Bản gzip của playlist, nén lại chỉ khi nội dung đổi"""
+    hit = _m3u8_gzip.get(path)
+    if hit is not None and hit[0] is data:
+        return hit[1]
+    gz = gzip.compress(data, compresslevel=6, mtime=0)
+    _m3u8_gzip[path] = (data, gz)
+    return gz
+
+
+def _last_msn(data: bytes) -> int:
+    """Media sequence number của segment cuối trong playlist (-1 nếu chưa có)"""
+    m = _MEDIA_SEQ_RE.search(data)
+    first = int(m.group(1)) if m else 0
+    return first + data.count(b"#EXTINF") - 1
+
+
+def _watch_playlists(watch):
+    global _playlist_seq
+    while True:
+        events = watch.wait()
+        changed = [name for _, name in events if name.endswith(".m3u8")]
+        if not changed:
+            continue
+        # Playlist vừa đổi -> bỏ cache để request đang chờ đọc bản mới ngay.
+        # Giữ lock: request đang đọc dở bản cũ trong _read_playlist không thể
+        # ghi đè lại sau khi pop
+        with _m3u8_lock:
+            for name in changed:
+                _m3u8_cache.pop((HLS_DIR / name).resolve(), None)
+        _hls_ready.set()
+        with _playlist_cv:
+            _playlist_seq += 1
+            _playlist_cv.notify_all()
+
+
+def _ensure_watcher() -> bool:
+    """Khởi động thread inotify 1 lần; False nếu không có inotify
+    hoặc HLS_DIR chưa được recorder tạo (sẽ thử lại ở request sau)"""
+    global _watcher_started, _watcher_retry_at
+    if _watcher_started is None:
+        if time.monotonic() < _watcher_retry_at:
+            return False
+        with _playlist_cv:
+            if _watcher_started is None:
+                try:
+                    watch = DirWatch(HLS_DIR, IN_CLOSE_WRITE | IN_MOVED_TO)
+                except (FileNotFoundError, NotADirectoryError):
+                    _watcher_retry_at = time.monotonic() + _WATCHER_RETRY
+                    return False
+                except OSError:
+                    _watcher_started = False
+                else:
+                    threading.Thread(target=_watch_playlists, args=(watch,), daemon=True).start()
+                    _watcher_started = True
+    return _watcher_started
+
+
+def _wait_for_hls_ready(path, timeout=_HLS_READY_TIMEOUT) -> bytes:
+    """Đọc playlist; nếu chưa có mà recorder đang chạy thì chờ tối đa timeout giây"""
+    try:
+        return _read_playlist(path)
+    except OSError:
+        pass
+    if not rec_is_active() or not _ensure_watcher():
+        return _EMPTY_PLAYLIST
+    deadline = time.monotonic() + timeout
+    while True:
+        _hls_ready.clear()
+        # Kiểm tra lại sau clear(): playlist có thể vừa được ghi trước đó
+        try:
+            return _read_playlist(path)
+        except OSError:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not _hls_ready.wait(remaining):
+            return _EMPTY_PLAYLIST
+
+
+def _wait_for_msn(path, msn: int) -> bytes:
+    """Chờ tới khi playlist chứa segment msn hoặc hết _HLS_BLOCK_TIMEOUT"""
+    # Lấy _playlist_seq TRƯỚC khi đọc playlist: bản ghi mới xen giữa lúc đọc
+    # và lúc chờ vẫn làm seq đổi -> không bị lỡ, không chờ oan tới timeout
+    with _playlist_cv:
+        seen = _playlist_seq
+    data = _wait_for_hls_ready(path)
+    last = _last_msn(data)
+    if last >= msn or data is _EMPTY_PLAYLIST or not _ensure_watcher():
+        return data
+    # LL-HLS: msn vượt quá segment cuối + 2 -> 400 ngay, không giữ request
+    if msn > last + 2:
+        abort(400, "_HLS_msn out of range")
+    deadline = time.monotonic() + _HLS_BLOCK_TIMEOUT
+    while _last_msn(data) < msn:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        with _playlist_cv:
+            if not _playlist_cv.wait_for(lambda: _playlist_seq != seen, remaining):
+                break
+            seen = _playlist_seq
+        # Vừa có event playlist mới -> stat lại file, không tin bản cache trong TTL
+        data = _load_playlist(path, fresh=True)
+    return data
 
 
 @bp.route("/hls/<path:filename>")
 @validate_request
 def serve_hls(filename):
-    """Phục vụ file HLS (m3u8, ts) từ thư mục /tmp/picam_hls"""
-    file_path = HLS_DIR / filename
-    if not file_path.exists() or not file_path.is_file():
+    """Phục vụ file HLS (m3u8, ts) từ HLS_DIR"""
+    # 1 lần tra dict theo đuôi file; đuôi lạ -> 404, không trả octet-stream
+    mimetype = _HLS_MIME.get(filename[filename.rfind("."):])
+    if mimetype is None:
+        abort(404, "File not found")
+    file_path = (_HLS_ROOT / filename).resolve()
+    # File phải thực sự nằm trong HLS_DIR (chặn ../ và symlink trỏ ra ngoài).
+    # So theo từng thành phần path: startswith() chuỗi sẽ lọt /dev/shm/picam_hls_x/...
+    if not file_path.is_relative_to(_HLS_ROOT):
+        abort(404, "File not found")
+
+    # Playlist: poll liên tục -> phục vụ từ cache, rỗng nếu recorder chưa ghi
+    if mimetype == _M3U8_MIME:
+        _ensure_watcher()  # có watcher thì playlist mới quảng bá CAN-BLOCK-RELOAD
+        msn = request.args.get("_HLS_msn", type=int)
+        if msn is not None:
+            data = _wait_for_msn(file_path, msn)
+        else:
+            data = _wait_for_hls_ready(file_path)
+        if len(data) < _GZIP_MIN_SIZE:
+            return Response(data, mimetype=mimetype, headers=_NO_CACHE_VARY)
+        if request.accept_encodings["gzip"]:
+            return Response(_gzip_playlist(file_path, data), mimetype=mimetype, headers=_NO_CACHE_GZIP)
+        return Response(data, mimetype=mimetype, headers=_NO_CACHE_VARY)
+
+    # Reverse proxy tự gửi file: nginx (X-Accel-Redirect, webui.x_accel) hoặc
+    # lighttpd/Apache (X-Sendfile, webui.x_sendfile)
+    x_accel = current_app.config.get("PICAM_X_ACCEL", False)
+    if x_accel or current_app.config["USE_X_SENDFILE"]:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            abort(404, "File not found")
+        if not stat.S_ISREG(st.st_mode):
+            abort(404, "File not found")
+        response = Response(mimetype=mimetype)
+        if x_accel:
+            rel = file_path.relative_to(_HLS_ROOT).as_posix()
+            response.headers["X-Accel-Redirect"] = _X_ACCEL_PREFIX + rel
+        else:
+            response.headers["X-Sendfile"] = str(file_path)
+        return _conditional_segment(response, st)
+
+    # Segment: mở 1 lần + fstat, đẩy qua wsgi.file_wrapper (gunicorn -> sendfile)
+    try:
+        f = open(file_path, "rb")
+    except OSError:
         abort(404, "File not found")
+    response = Response(
+        wrap_file(request.environ, f, 65536),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    return _conditional_segment(response, os.fstat(f.fileno()))
 
-    # Trả về file đúng MIME type
-    if filename.endswith(".m3u8"):
-        mimetype = "application/vnd.apple.mpegurl"
-    elif filename.endswith(".ts"):
-        mimetype = "video/mp2t"
-    else:
-        mimetype = "application/octet-stream"
 
-    return send_from_directory(HLS_DIR, filename, mimetype=mimetype)
+def _conditional_segment(response, st):
+    """ETag/Last-Modified theo (inode, mtime, size) + 304 khi client đã có segment"""
+    response.content_length = st.st_size
+    response.set_etag(f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}")
+    response.last_modified = st.st_mtime
+    response.headers["Cache-Control"] = _SEGMENT_CACHE
+    response.headers.update(_CORS)
+    # make_conditional tự bỏ body (và đóng file) khi trả 304
+    return response.make_conditional(request)
@@ -1,8 +1,10 @@
 from __future__ import annotations
-import subprocess, shutil, time, re, os
+import subprocess, shutil, time, re, os, threading, socket, struct, fcntl, heapq, codecs, hashlib, base64
 from pathlib import Path
 from typing import Dict, Any, List
-from flask import request, current_app
+from functools import lru_cache
+from flask import current_app, g
+from firmware.config.config_loader import load as load_cfg, hls_dir
 # import gpiod an toàn: nếu thiếu lib thì gpiod=None (WebUI vẫn chạy)
 try:
     import gpiod
@@ -18,9 +20,15 @@ except Exception:
 #     print(f"Warning: Could not import VideoRecorder: {e}")
 #     VideoRecorder = None
     
-APPLE_RE = re.compile(r"(iPhone|iPad|iPod|Macintosh).*Safari", re.I)
+def _resolve_hls_dir() -> Path:
+    """Cùng thư mục HLS với recorder (đọc paths.hls_dir từ cùng file config)"""
+    cfg_path = os.environ.get("PICAM_CONFIG") or Path(__file__).resolve().parents[2] / "config" / "device_full.yaml"
+    try:
+        return hls_dir(load_cfg(cfg_path))
+    except Exception:
+        return hls_dir({})
 
-HLS_DIR = Path("/tmp/picam_hls")
+HLS_DIR = _resolve_hls_dir()
 FLAG_REC = Path("/tmp/picam.recorder.active")
 
 # Global recorder instance
@@ -52,6 +60,7 @@ def start_service(service):
     """Start service"""
     print(f"▶️ Starting {service} ...")
     _, err = run_command(["sudo", "systemctl", "start", service])
+    _rec_state["t"] = 0.0  # trạng thái đã đổi -> bỏ memo
     if err:
         print(f"⚠ Error starting {service}: {err}")
     else:
@@ -62,6 +71,7 @@ def stop_service(service):
     """Stop service"""
     print(f"⏹ Stopping {service} ...")
     _, err = run_command(["sudo", "systemctl", "stop", service])
+    _rec_state["t"] = 0.0  # trạng thái đã đổi -> bỏ memo
     if err:
         print(f"⚠ Error stopping {service}: {err}")
     else:
@@ -107,15 +117,21 @@ def _gpio_set_named(name: str, on: bool):
         return
         
         
-def _fstype(path: Path) -> str:
+def _mount_entry(mountpoint: str):
+    """(device, fstype) của mount point từ /proc/mounts, ("", "") nếu không mount"""
     try:
-        out = subprocess.check_output(
-            ["/usr/bin/findmnt","-n","-o","FSTYPE", str(path)],
-            stderr=subprocess.DEVNULL, text=True
-        ).strip()
-        return out
-    except Exception:
-        return ""
+        with open("/proc/mounts", encoding="utf-8", errors="ignore") as f:
+            for ln in f:
+                parts = ln.split()
+                # Dấu cách trong đường dẫn được kernel escape thành \040
+                if len(parts) >= 3 and parts[1].replace("\\040", " ") == mountpoint:
+                    return parts[0], parts[2]
+    except OSError:
+        pass
+    return "", ""
+
+def _fstype(path: Path) -> str:
+    return _mount_entry(str(path))[1]
 
 def ensure_dirs(record_root: Path):
     # /media/ssd có thể là autofs khi chưa cắm USB → mkdir có thể ENODEV → bỏ qua
@@ -128,10 +144,18 @@ def ensure_dirs(record_root: Path):
     except OSError:
         pass
 
+@lru_cache(maxsize=256)
+def _cfg_keys(path: str) -> tuple:
+    """'wifi.iface' -> ('wifi', 'iface'); mỗi đường dẫn chỉ split 1 lần"""
+    return tuple(path.split("."))
+
 def cfg_get(path: str, default=None):
-    cfg = current_app.config.get("PICAM_CFG", {})
+    # Dict config lấy 1 lần mỗi request rồi giữ trong flask.g
+    cfg = g.get("_picam_cfg")
+    if cfg is None:
+        cfg = g._picam_cfg = current_app.config.get("PICAM_CFG", {})
     cur = cfg
-    for key in path.split("."):
+    for key in _cfg_keys(path):
         if not isinstance(cur, dict) or key not in cur:
             return default
         cur = cur[key]
@@ -144,46 +168,92 @@ def run(cmd: List[str]) -> str:
     except Exception:
         return ""
 
+# Trạng thái interface đọc thẳng từ kernel (sysfs + ioctl), không fork `ip`
+SIOCGIFADDR = 0x8915
+SYS_NET = Path("/sys/class/net")
+
 def iface_has_ip(iface: str) -> bool:
-    return "inet " in (run(["/usr/sbin/ip","-4","addr","show","dev",iface]) or run(["/sbin/ip","-4","addr","show","dev",iface]))
+    # SIOCGIFADDR lỗi (EADDRNOTAVAIL/ENODEV) khi interface chưa có IPv4
+    ifreq = struct.pack("256s", iface.encode()[:15])
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)
+        return True
+    except OSError:
+        return False
 
 def iface_is_up(iface: str) -> bool:
-    out = run(["/usr/sbin/ip","link","show","dev",iface]) or run(["/sbin/ip","link","show","dev",iface])
-    return "state UP" in out or "UP" in out.split()
+    try:
+        return (SYS_NET / iface / "operstate").read_text().strip() == "up"
+    except OSError:
+        return False
 
 def lte_iface_present(iface: str) -> bool:
-    return bool(run(["/usr/sbin/ip","link","show","dev",iface]) or run(["/sbin/ip","link","show","dev",iface]))
+    return (SYS_NET / iface).exists()
+
+# Dung lượng đĩa và phần cứng đổi theo phút, WebUI poll theo giây -> cache TTL
+_DISK_TTL = 2.0
+_HW_TTL = 30.0
+_disk_cache: Dict[str, tuple] = {}   # {path: (t, info)}
+_hw_cache = {"t": 0.0, "v": None}
 
 def disk_info(p: Path) -> Dict[str, Any]:
+    key = str(p)
+    hit = _disk_cache.get(key)
+    now = time.monotonic()
+    if hit is not None and now - hit[0] < _DISK_TTL:
+        return hit[1]
+    info = _disk_info(key)
+    _disk_cache[key] = (now, info)
+    return info
+
+def _disk_info(p: str) -> Dict[str, Any]:
     gb = 1024**3
     try:
-        total, used, free = shutil.disk_usage(str(p))
+        total, used, free = shutil.disk_usage(p)
         return dict(total_gb=round(total/gb,1), used_gb=round(used/gb,1), free_gb=round(free/gb,1))
     except Exception:
         # khi autofs chưa mount thật → trả 0 thay vì 500
         return dict(total_gb=0.0, used_gb=0.0, free_gb=0.0)
 
+_MEDIA_EXTS = (".mkv", ".mp4", ".ts")
+
 def list_media(p: Path) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
+    # 1 lần scandir cho mọi đuôi file; chỉ stat và dựng dict cho 200 file mới nhất
+    names: List[tuple] = []
     try:
-        if p.exists():
-            for ext in ("*.mkv","*.mp4","*.ts"):
-                for entry in p.glob(ext):
-                    try:
-                        items.append(dict(name=entry.name, size_mb=entry.stat().st_size/1024/1024))
-                    except Exception:
-                        pass
+        with os.scandir(p) as it:
+            for de in it:
+                if de.name.endswith(_MEDIA_EXTS) and de.is_file(follow_symlinks=False):
+                    names.append((de.name, de.path))
     except Exception:
         pass
-    # 200 file mới nhất
-    return list(sorted(items, key=lambda x: x["name"]))[-200:][::-1]
+    items: List[Dict[str, Any]] = []
+    # 200 file mới nhất (tên file bắt đầu bằng timestamp -> tên lớn nhất = mới nhất)
+    for name, path in heapq.nlargest(200, names):
+        try:
+            items.append(dict(name=name, size_mb=os.stat(path).st_size/1024/1024))
+        except Exception:
+            pass
+    return items
+
+# Memo trạng thái picam-recorder: systemctl tốn 1 lần fork, nhiều request
+# đồng thời trong _REC_TTL giây dùng chung 1 kết quả
+_REC_TTL = 0.5
+_rec_state = {"t": 0.0, "v": False}
+_rec_lock = threading.Lock()
 
 def get_recorder():
     """Get or create global recorder instance"""
-    status = check_service("picam-recorder")
-    if status == "active":
-        return True
-    return False
+    if time.monotonic() - _rec_state["t"] < _REC_TTL:
+        return _rec_state["v"]
+    with _rec_lock:
+        if time.monotonic() - _rec_state["t"] < _REC_TTL:
+            return _rec_state["v"]
+        active = check_service("picam-recorder") == "active"
+        _rec_state["v"] = active
+        _rec_state["t"] = time.monotonic()
+        return active
 
 def rec_is_active() -> bool:
     """Check if recording is active - use recorder if available, fallback to flag file"""
@@ -239,6 +309,14 @@ def gps_device_present() -> bool:
         return False
 
 def leds_status() -> Dict[str,str]:
+    # /status và dashboard có thể gọi nhiều lần trong 1 request -> tính 1 lần
+    cached = g.get("_leds_status")
+    if cached is not None:
+        return cached
+    g._leds_status = _leds_status()
+    return g._leds_status
+
+def _leds_status() -> Dict[str,str]:
     wifi = cfg_get("wifi.iface","wlan0")
     lte  = cfg_get("lte.iface","wwan0")
     rec = "on" if rec_is_active() else "off"
@@ -254,12 +332,16 @@ def leds_status() -> Dict[str,str]:
     gps_state  = "on" if gps_device_present() else "off"
     return dict(record=rec, wifi=wifi_state, lte=lte_state, gps=gps_state, factory="off")
 
-def client_prefers_hls() -> bool:
-    force = (request.args.get("force","") or "").lower()
-    if force == "hls": return True
-    if force == "mjpeg": return False
-    ua = request.headers.get("User-Agent","")
-    return bool(APPLE_RE.search(ua))
+STATIC_DIR = Path(__file__).parent / "static"
+
+@lru_cache(maxsize=8)
+def static_sri(name: str) -> str:
+    """Subresource Integrity (sha384) của file trong static/, tính 1 lần mỗi process"""
+    try:
+        digest = hashlib.sha384((STATIC_DIR / name).read_bytes()).digest()
+    except OSError:
+        return ""
+    return "sha384-" + base64.b64encode(digest).decode("ascii")
 
 
 # --- Thời gian hệ thống & RTC (hiển thị lên WebUI) ---
@@ -275,7 +357,7 @@ def time_info() -> Dict[str, Any]:
     - tz: múi giờ cấu hình (Asia/Ho_Chi_Minh)
     - sys_local: thời gian hệ thống theo múi giờ VN
     - sys_utc: thời gian hệ thống UTC
-    - rtc: chuỗi hwclock -r (UTC) nếu có
+    - rtc: thời gian RTC (UTC) đọc từ /sys/class/rtc/rtc0, fallback hwclock -r
     """
     tzname = "Asia/Ho_Chi_Minh"
     try:
@@ -287,8 +369,16 @@ def time_info() -> Dict[str, Any]:
         now_local = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
     else:
         now_local = run(["/usr/bin/date","+%Y-%m-%d %H:%M:%S"]) or ""
+    return dict(tz=tzname, sys_local=now_local, sys_utc=now_utc, rtc=_rtc_time())
+
+def _rtc_time() -> str:
+    # Driver RTC xuất sẵn date/time qua sysfs -> đọc 2 file thay vì fork hwclock
+    rtc_date = _readfile("/sys/class/rtc/rtc0/date")
+    rtc_time = _readfile("/sys/class/rtc/rtc0/time")
+    if rtc_date and rtc_time:
+        return f"{rtc_date} {rtc_time}"
     rtc_str = run(["/sbin/hwclock","-r"]) or run(["/usr/sbin/hwclock","-r"])
-    return dict(tz=tzname, sys_local=now_local, sys_utc=now_utc, rtc=rtc_str.strip())
+    return rtc_str.strip()
 
 
 # --- Thông tin phần cứng: RTC / Camera / Lưu trữ ---
@@ -298,7 +388,29 @@ def _readfile(p: str) -> str:
     except Exception:
         return ""
 
+def _human_size(n: int) -> str:
+    """Định dạng giống lsblk: 512 -> 512B, 62537072640 -> 58.2G"""
+    size = float(n)
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024 or unit == "T":
+            txt = f"{size:.1f}".rstrip("0").rstrip(".")
+            return f"{txt}{unit}"
+        size /= 1024
+    return ""
+
+# ví dụ "rtc-ds1307 1-0068" -> driver=ds1307, bus=1, addr=0x68
+_RTC_RE = re.compile(r"rtc-([a-z0-9]+)\s+(\d+)-00([0-9a-f]{2})", re.I)
+
 def hw_inventory() -> Dict[str, Any]:
+    now = time.monotonic()
+    if _hw_cache["v"] is not None and now - _hw_cache["t"] < _HW_TTL:
+        return _hw_cache["v"]
+    info = _hw_inventory()
+    _hw_cache["v"] = info
+    _hw_cache["t"] = now
+    return info
+
+def _hw_inventory() -> Dict[str, Any]:
     """
     Trả về dict mô tả phần cứng đang kết nối để hiển thị lên WebUI.
     - rtc: model/bus/addr lấy từ dmesg hoặc /sys/class/rtc/rtc0
@@ -313,15 +425,15 @@ def hw_inventory() -> Dict[str, Any]:
     dmesg_line = ""
     try:
         dmesg_out = run(["/bin/dmesg"]) or ""
-        for ln in dmesg_out.splitlines():
+        # Lấy dòng khớp cuối cùng: duyệt ngược và dừng ở dòng đầu tiên gặp
+        for ln in reversed(dmesg_out.splitlines()):
             if "rtc-" in ln and "registered as rtc0" in ln:
                 dmesg_line = ln
-        # ví dụ tách "rtc-ds1307 1-0068" -> driver=ds1307, bus=1, addr=0x68
+                break
         driver = ""
         bus = ""
         addr = ""
-        import re as _re
-        m = _re.search(r"rtc-([a-z0-9]+)\s+(\d+)-00([0-9a-f]{2})", dmesg_line, flags=_re.I)
+        m = _RTC_RE.search(dmesg_line)
         if m:
             driver = m.group(1).lower()
             bus = m.group(2)
@@ -347,27 +459,29 @@ def hw_inventory() -> Dict[str, Any]:
                     cam["name"] = (cam["name"] + " " + ln.split(":",1)[-1].strip()).strip()
     info["camera"] = cam
 
-    # Storage @ /media/ssd
+    # Storage @ /media/ssd: /proc/mounts + sysfs + /dev/disk/by-label, không fork lsblk
     stor = {"mount": "/media/ssd", "label": "", "fstype": "", "model": "", "size": ""}
     try:
-        import json as _json, subprocess
-        ls = subprocess.check_output(["/usr/bin/lsblk","-J","-o","NAME,LABEL,FSTYPE,SIZE,MODEL,MOUNTPOINTS"], text=True)
-        jo = _json.loads(ls)
-        def walk(nodes):
-            for nd in nodes:
-                mps = (nd.get("mountpoints") or nd.get("mountpoint") or []) or []
-                if "/media/ssd" in mps:
-                    return nd
-                if "children" in nd and nd["children"]:
-                    r = walk(nd["children"])
-                    if r: return r
-            return None
-        nd = walk(jo.get("blockdevices",[]))
-        if nd:
-            stor["label"] = nd.get("label") or ""
-            stor["fstype"] = nd.get("fstype") or ""
-            stor["model"] = nd.get("model") or ""
-            stor["size"]  = nd.get("size") or ""
+        dev, fstype = _mount_entry("/media/ssd")
+        if dev.startswith("/dev/"):
+            stor["fstype"] = fstype
+            real = os.path.realpath(dev)
+            blk = Path("/sys/class/block") / os.path.basename(real)
+            sectors = _readfile(str(blk / "size"))
+            if sectors.isdigit():
+                stor["size"] = _human_size(int(sectors) * 512)
+            # Phân vùng (sda1) -> model nằm ở thiết bị cha (sda)
+            sys_dev = blk.resolve()
+            model = _readfile(str(sys_dev / "device" / "model")) or \
+                    _readfile(str(sys_dev.parent / "device" / "model"))
+            stor["model"] = model
+            by_label = Path("/dev/disk/by-label")
+            if by_label.is_dir():
+                for link in by_label.iterdir():
+                    if os.path.realpath(link) == real:
+                        # udev escape ký tự đặc biệt trong label thành \xNN
+                        stor["label"] = codecs.escape_decode(link.name.encode())[0].decode("utf-8", "replace")
+                        break
     except Exception:
         pass
     info["storage"] = stor
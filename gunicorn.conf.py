@@ -0,0 +1,47 @@
+# /home/admin/pi3b-/gunicorn.conf.py
+# Chạy WebUI bằng gunicorn thay cho app.run (dev server 1 thread):
+#   gunicorn -c gunicorn.conf.py run_webui:app
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from firmware.config.config_loader import load as load_cfg
+
+_cfg = load_cfg(os.environ.get("PICAM_CONFIG", "firmware/config/device_full.yaml"))
+_web = _cfg.get("webui", {}) or {}
+
+# webui.bind = "unix:/tmp/picam-web.sock" khi nginx đứng trước (nginx/picam.conf)
+bind = _web.get("bind") or f"{_web.get('host', '0.0.0.0')}:{int(_web.get('port', 8080))}"
+
+# gthread: tải segment chậm không chặn các route khác (/status, playlist)
+# gevent (webui.worker hoặc PICAM_WEB_WORKER=gevent, cần `pip install gevent`):
+# 1 worker epoll phục vụ hàng chục client HLS với ít RAM hơn
+worker_class = os.environ.get("PICAM_WEB_WORKER") or _web.get("worker", "gthread")
+if worker_class == "gevent":
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        print("⚠️ gevent chưa cài -> dùng gthread")
+        worker_class = "gthread"
+if worker_class == "gevent":
+    workers = 1
+else:
+    workers = 2
+    threads = 8
+worker_connections = 64
+# File heartbeat của worker để trên RAM, không ghi thẻ SD
+worker_tmp_dir = "/dev/shm"
+# Playlist có thể giữ request tới 3s (_HLS_msn) -> timeout rộng hơn mức đó
+timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    """Ghim master (worker kế thừa) vào core khác FFmpeg (video.ffmpeg_cpus)"""
+    cpus = _web.get("cpus") or []
+    if cpus:
+        try:
+            os.sched_setaffinity(0, set(cpus))
+            server.log.info("CPU affinity: %s", sorted(cpus))
+        except (OSError, AttributeError) as e:
+            server.log.warning("Could not set CPU affinity: %s", e)
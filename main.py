@@ -1,15 +1,9 @@
-# /home/admin/run_webui.py
+# Tên cũ của entry point WebUI -> chuyển sang run_webui.py, không dựng Flask app thứ 2
 import os
-from firmware.config.config_loader import load as load_cfg
-from firmware.interface.webui import create_app
-
-cfg_path = os.environ.get("PICAM_CONFIG", "firmware/config/device_full.yaml")
-cfg = load_cfg(cfg_path)
-
-app = create_app(cfg)
-host = (cfg.get("webui", {}) or {}).get("host", "0.0.0.0")
-port = int((cfg.get("webui", {}) or {}).get("port", 8080))
+import runpy
 
 if __name__ == "__main__":
-    # Simple Flask app - no SocketIO needed for HLS
-    app.run(host=host, port=port, debug=False)
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_webui.py"),
+                   run_name="__main__")
+else:
+    from run_webui import app  # noqa: F401
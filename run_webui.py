@@ -1,5 +1,6 @@
 # /home/admin/run_webui.py
 import os
+import shutil
 from firmware.config.config_loader import load as load_cfg
 from firmware.interface.webui import create_app
 
@@ -7,9 +8,16 @@ cfg_path = os.environ.get("PICAM_CONFIG", "firmware/config/device_full.yaml")
 cfg = load_cfg(cfg_path)
 
 app = create_app(cfg)
-host = (cfg.get("webui", {}) or {}).get("host", "0.0.0.0")
-port = int((cfg.get("webui", {}) or {}).get("port", 8080))
+webui_cfg = cfg.get("webui") or {}
+host = webui_cfg.get("host", "0.0.0.0")
+port = int(webui_cfg.get("port", 8080))
 
 if __name__ == "__main__":
-    # Simple Flask app - no SocketIO needed for HLS
-    app.run(host=host, port=port, debug=False)
+    # Chạy tay cũng qua gunicorn như service (gunicorn.conf.py);
+    # PICAM_DEV=1 hoặc chưa cài gunicorn -> dev server Flask để debug
+    if os.environ.get("PICAM_DEV") == "1" or shutil.which("gunicorn") is None:
+        app.run(host=host, port=port, debug=False)
+    else:
+        root = os.path.dirname(os.path.abspath(__file__))
+        os.execvp("gunicorn", ["gunicorn", "-c", os.path.join(root, "gunicorn.conf.py"),
+                               "--chdir", root, "run_webui:app"])